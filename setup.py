@@ -7,10 +7,10 @@ try:
 except IOError:
     long_desc = 'This package adds features to Sphinx to make it easier to link to resources on BitBucket.'
 
-requires = ['Sphinx>=0.6', 'docutils>=0.6']
+requires = ['Sphinx>=1.3', 'docutils>=0.6']
 
 NAME='sphinxcontrib-bitbucket'
-VERSION='1.0'
+VERSION='1.1'
 
 setup(
     name=NAME,
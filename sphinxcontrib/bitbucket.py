@@ -6,9 +6,167 @@
 """Integration of Sphinx with BitBucket.
 """
 
+import bisect
+import json
+import os
+import time
+from xml.sax.saxutils import escape, quoteattr
+
 from docutils import nodes, utils
 from docutils.parsers.rst.roles import set_classes
 
+# Number of builds kept in the report history file.
+HISTORY_LENGTH = 50
+
+
+class RankedCounter(object):
+    """Counter that can list its largest entries without a full sort.
+
+    Keys are grouped into buckets by their count.  Each bucket is kept
+    as a sorted list and the distinct counts are kept sorted, so
+    finding the top *n* entries only touches the distinct counts and
+    the *n* keys it returns.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        # count -> sorted list of keys
+        self.buckets = {}
+        # distinct counts, in ascending order
+        self.levels = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def get(self, key):
+        return self.counts.get(key, 0)
+
+    def add(self, key, delta=1):
+        """Change the count for *key* by *delta*, dropping it at zero.
+        """
+        old = self.counts.get(key, 0)
+        new = old + delta
+        if old:
+            bucket = self.buckets[old]
+            del bucket[bisect.bisect_left(bucket, key)]
+            if not bucket:
+                del self.buckets[old]
+                del self.levels[bisect.bisect_left(self.levels, old)]
+        if new > 0:
+            self.counts[key] = new
+            if new not in self.buckets:
+                self.buckets[new] = []
+                bisect.insort(self.levels, new)
+            bisect.insort(self.buckets[new], key)
+        else:
+            self.counts.pop(key, None)
+
+    def top(self, n):
+        """Return up to *n* ``(key, count)`` pairs, largest count first.
+
+        Keys with the same count are ordered by key.
+        """
+        result = []
+        for count in reversed(self.levels):
+            wanted = n - len(result)
+            if wanted <= 0:
+                break
+            result.extend((key, count) for key in self.buckets[count][:wanted])
+        return result
+
+
+class ReferenceIndex(object):
+    """BitBucket references collected from documents while reading.
+
+    The aggregates are updated as each document is read or purged, so
+    the report is not rebuilt by walking every document.
+    """
+
+    # Changed whenever the stored layout changes, so environments saved
+    # with an older layout are read again from scratch.
+    VERSION = 2
+
+    def __init__(self):
+        self.version = self.VERSION
+        # docname -> list of (type, slug, valid) tuples
+        self.refs = {}
+        self.documents = RankedCounter()
+        self.issues = RankedCounter()
+        # issue number -> {docname: count}
+        self.issue_docs = {}
+        # docname -> list of invalid reference texts
+        self.invalid = {}
+        self.total = 0
+        self.total_invalid = 0
+
+    def record(self, docname, type, slug, valid=True):
+        """Remember one reference found in *docname*.
+        """
+        self.refs.setdefault(docname, []).append((type, slug, valid))
+        self.total += 1
+        self.documents.add(docname)
+        if not valid:
+            self.invalid.setdefault(docname, []).append(slug)
+            self.total_invalid += 1
+        elif type == 'issue':
+            self.issues.add(slug)
+            docs = self.issue_docs.setdefault(slug, {})
+            docs[docname] = docs.get(docname, 0) + 1
+
+    def purge(self, docname):
+        """Forget everything recorded for *docname*.
+        """
+        for type, slug, valid in self.refs.pop(docname, []):
+            self.total -= 1
+            self.documents.add(docname, -1)
+            if not valid:
+                self.total_invalid -= 1
+            elif type == 'issue':
+                self.issues.add(slug, -1)
+                docs = self.issue_docs[slug]
+                docs[docname] -= 1
+                if not docs[docname]:
+                    del docs[docname]
+                if not docs:
+                    del self.issue_docs[slug]
+        self.invalid.pop(docname, None)
+
+    def closed(self, closed_issues):
+        """Return ``(issue, docnames)`` pairs for cited closed issues.
+        """
+        result = []
+        for issue in sorted(set(str(i) for i in closed_issues), key=_issue_key):
+            docs = self.issue_docs.get(issue)
+            if docs:
+                result.append((issue, sorted(docs)))
+        return result
+
+
+def _issue_key(issue):
+    try:
+        return (0, int(issue))
+    except ValueError:
+        return (1, issue)
+
+
+def get_reference_index(env):
+    """Return the reference index stored in the build environment.
+    """
+    index = getattr(env, 'bitbucket_references', None)
+    if index is None:
+        index = env.bitbucket_references = ReferenceIndex()
+    return index
+
+
+def record_reference(inliner, type, slug, valid=True):
+    """Add a reference to the index of the document being read.
+    """
+    env = getattr(inliner.document.settings, 'env', None)
+    if env is None:
+        return
+    get_reference_index(env).record(env.docname, type, slug, valid)
+
+
 def make_link_node(rawtext, app, type, slug, options):
     """Create a link to a BitBucket resource.
 
@@ -58,9 +216,11 @@ def bbissue_role(name, rawtext, text, lineno, inliner, options={}, content=[]):
             'BitBucket issue number must be a number greater than or equal to 1; '
             '"%s" is invalid.' % text, line=lineno)
         prb = inliner.problematic(rawtext, rawtext, msg)
+        record_reference(inliner, 'issue', text, valid=False)
         return [prb], [msg]
     app = inliner.document.settings.env.app
     #app.info('issue %r' % text)
+    record_reference(inliner, 'issue', str(issue_num))
     node = make_link_node(rawtext, app, 'issue', str(issue_num), options)
     return [node], []
 
@@ -81,6 +241,7 @@ def bbchangeset_role(name, rawtext, text, lineno, inliner, options={}, content=[
     """
     app = inliner.document.settings.env.app
     #app.info('changeset %r' % text)
+    record_reference(inliner, 'changeset', text)
     node = make_link_node(rawtext, app, 'changeset', text, options)
     return [node], []
 
@@ -101,11 +262,170 @@ def bbuser_role(name, rawtext, text, lineno, inliner, options={}, content=[]):
     """
     app = inliner.document.settings.env.app
     #app.info('user link %r' % text)
+    record_reference(inliner, 'user', text)
     ref = 'https://bitbucket.org/' + text
     node = nodes.reference(rawtext, text, refuri=ref, **options)
     return [node], []
 
 
+def purge_references(app, env, docname):
+    """Drop the references of a document that is about to be re-read.
+    """
+    get_reference_index(env).purge(docname)
+
+
+def merge_references(app, env, docnames, other):
+    """Copy references collected by a parallel reader into *env*.
+    """
+    index = get_reference_index(env)
+    other_index = get_reference_index(other)
+    for docname in docnames:
+        for type, slug, valid in other_index.refs.get(docname, []):
+            index.record(docname, type, slug, valid)
+
+
+def outdated_documents(app, env, added, changed, removed):
+    """Re-read every document if the environment has no usable index.
+
+    An environment saved before the index existed, or with an older
+    index layout, would otherwise only report the references of
+    documents that happen to be re-read.
+    """
+    index = getattr(env, 'bitbucket_references', None)
+    if getattr(index, 'version', None) == ReferenceIndex.VERSION:
+        return []
+    env.bitbucket_references = ReferenceIndex()
+    return list(env.found_docs)
+
+
+def load_history(filename):
+    """Read the list of previous report data points.
+    """
+    try:
+        with open(filename, 'r') as f:
+            history = json.load(f)
+    except (IOError, OSError, ValueError):
+        return []
+    if not isinstance(history, list):
+        return []
+    return history
+
+
+def save_history(filename, history):
+    """Write the most recent report data points.
+    """
+    history = history[-HISTORY_LENGTH:]
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(filename, 'w') as f:
+        json.dump(history, f, indent=1)
+    return history
+
+
+def _doc_link(app, pagename, docname):
+    uri = app.builder.get_relative_uri(pagename, docname)
+    return '<a href=%s>%s</a>' % (quoteattr(uri), escape(docname))
+
+
+def _issue_link(app, issue):
+    base = app.config.bitbucket_project_url
+    if not base:
+        return escape('issue ' + issue)
+    slash = '/' if base[-1] != '/' else ''
+    ref = base + slash + 'issue/' + issue + '/'
+    return '<a href=%s>issue %s</a>' % (quoteattr(ref), escape(issue))
+
+
+def _table(headers, rows):
+    out = ['<table class="docutils">', '<thead><tr>']
+    out.extend('<th>%s</th>' % escape(h) for h in headers)
+    out.append('</tr></thead><tbody>')
+    for row in rows:
+        out.append('<tr>')
+        out.extend('<td>%s</td>' % cell for cell in row)
+        out.append('</tr>')
+    out.append('</tbody></table>')
+    return '\n'.join(out)
+
+
+def render_report(app, pagename, index, closed, history):
+    """Build the HTML body of the reference report page.
+    """
+    size = max(app.config.bitbucket_report_size or 0, 0)
+    body = ['<h1>BitBucket References</h1>']
+
+    body.append('<h2>Documents with the most references</h2>')
+    body.append(_table(
+        ['Document', 'References'],
+        [(_doc_link(app, pagename, doc), count)
+         for doc, count in index.documents.top(size)],
+    ))
+
+    body.append('<h2>Most cited issues</h2>')
+    body.append(_table(
+        ['Issue', 'Citations'],
+        [(_issue_link(app, issue), count)
+         for issue, count in index.issues.top(size)],
+    ))
+
+    body.append('<h2>Invalid references</h2>')
+    body.append(_table(
+        ['Document', 'Reference'],
+        [(_doc_link(app, pagename, doc), escape(text))
+         for doc in sorted(index.invalid)
+         for text in index.invalid[doc]],
+    ))
+
+    body.append('<h2>References to closed issues</h2>')
+    body.append(_table(
+        ['Issue', 'Documents'],
+        [(_issue_link(app, issue),
+          ', '.join(_doc_link(app, pagename, doc) for doc in docs))
+         for issue, docs in closed],
+    ))
+
+    body.append('<h2>History</h2>')
+    body.append(_table(
+        ['Build', 'References', 'Documents', 'Invalid', 'Closed'],
+        [(escape(point.get('date', '')), point.get('references', 0),
+          point.get('documents', 0), point.get('invalid', 0),
+          point.get('closed', 0))
+         for point in reversed(history)],
+    ))
+    return '\n'.join(body)
+
+
+def collect_report_page(app):
+    """Generate the reference report page for HTML builders.
+    """
+    pagename = app.config.bitbucket_report_page
+    if not pagename:
+        return []
+    index = get_reference_index(app.builder.env)
+    closed = index.closed(app.config.bitbucket_closed_issues)
+    base, ext = os.path.splitext(app.config.bitbucket_report_history)
+    filename = os.path.join(app.doctreedir,
+                            '%s-%s%s' % (base, app.builder.name, ext))
+    history = load_history(filename)
+    totals = {
+        'references': index.total,
+        'documents': len(index.documents),
+        'invalid': index.total_invalid,
+        'closed': sum(len(docs) for issue, docs in closed),
+    }
+    last = history[-1] if history else {}
+    if any(last.get(name) != value for name, value in totals.items()):
+        totals['date'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        history.append(totals)
+        history = save_history(filename, history)
+    context = {
+        'title': 'BitBucket References',
+        'body': render_report(app, pagename, index, closed, history),
+    }
+    return [(pagename, context, 'page.html')]
+
+
 def setup(app):
     """Install the plugin.
     
@@ -116,5 +436,14 @@ def setup(app):
     app.add_role('bbchangeset', bbchangeset_role)
     app.add_role('bbuser', bbuser_role)
     app.add_config_value('bitbucket_project_url', None, 'env')
-    return
+    app.add_config_value('bitbucket_report_page', None, 'html')
+    app.add_config_value('bitbucket_report_size', 10, 'html')
+    app.add_config_value('bitbucket_closed_issues', [], 'html')
+    app.add_config_value('bitbucket_report_history',
+                         'bitbucket_history.json', 'html')
+    app.connect('env-get-outdated', outdated_documents)
+    app.connect('env-purge-doc', purge_references)
+    app.connect('env-merge-info', merge_references)
+    app.connect('html-collect-pages', collect_report_page)
+    return {'parallel_read_safe': True}
 
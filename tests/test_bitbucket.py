@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Tests for the reference report in sphinxcontrib.bitbucket.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from docutils import nodes
+
+from sphinxcontrib import bitbucket
+
+
+class FakeConfig(object):
+
+    def __init__(self, **kwds):
+        self.bitbucket_project_url = 'https://bitbucket.org/owner/project'
+        self.bitbucket_report_page = 'bitbucket-report'
+        self.bitbucket_report_size = 10
+        self.bitbucket_closed_issues = []
+        self.bitbucket_report_history = 'bitbucket_history.json'
+        self.__dict__.update(kwds)
+
+
+class FakeEnv(object):
+
+    def __init__(self, app=None, docname=None, found_docs=()):
+        self.app = app
+        self.docname = docname
+        self.found_docs = set(found_docs)
+
+
+class FakeBuilder(object):
+
+    def __init__(self, env, name='html'):
+        self.env = env
+        self.name = name
+
+    def get_relative_uri(self, from_, to):
+        return to + '.html'
+
+
+class FakeApp(object):
+
+    def __init__(self, doctreedir, builder_name='html', **config):
+        self.config = FakeConfig(**config)
+        self.doctreedir = doctreedir
+        self.builder = FakeBuilder(FakeEnv(self), builder_name)
+
+
+class FakeReporter(object):
+
+    def error(self, message, line=None):
+        return nodes.system_message(message)
+
+
+class FakeInliner(object):
+
+    def __init__(self, env):
+        self.reporter = FakeReporter()
+        self.document = nodes.document(None, None)
+        self.document.settings = type('Settings', (object,), {'env': env})
+
+    def problematic(self, text, rawsource, message):
+        return nodes.problematic(rawsource, text)
+
+
+class RankedCounterTest(unittest.TestCase):
+
+    def test_add_and_remove(self):
+        counter = bitbucket.RankedCounter()
+        counter.add('a')
+        counter.add('a')
+        counter.add('a', -2)
+        self.assertEqual(len(counter), 0)
+        self.assertEqual(counter.get('a'), 0)
+        self.assertEqual(counter.buckets, {})
+        self.assertEqual(counter.levels, [])
+
+    def test_top_orders_ties_by_key(self):
+        counter = bitbucket.RankedCounter()
+        for key in ['c', 'b', 'a', 'd', 'd']:
+            counter.add(key)
+        self.assertEqual(counter.top(3), [('d', 2), ('a', 1), ('b', 1)])
+
+    def test_top_shorter_than_n(self):
+        counter = bitbucket.RankedCounter()
+        counter.add('a')
+        self.assertEqual(counter.top(5), [('a', 1)])
+
+    def test_top_follows_changes(self):
+        counter = bitbucket.RankedCounter()
+        for key in ['a', 'a', 'b', 'c']:
+            counter.add(key)
+        self.assertEqual(counter.top(2), [('a', 2), ('b', 1)])
+        counter.add('c', 2)
+        self.assertEqual(counter.top(2), [('c', 3), ('a', 2)])
+        counter.add('c', -3)
+        self.assertEqual(counter.top(2), [('a', 2), ('b', 1)])
+
+    def test_top_after_change_below_cutoff(self):
+        counter = bitbucket.RankedCounter()
+        for key in ['a', 'a', 'b', 'b', 'c']:
+            counter.add(key)
+        self.assertEqual(counter.top(2), [('a', 2), ('b', 2)])
+        counter.add('d')
+        counter.add('c', -1)
+        self.assertEqual(counter.top(2), [('a', 2), ('b', 2)])
+        self.assertEqual(counter.top(3), [('a', 2), ('b', 2), ('d', 1)])
+
+    def test_top_after_change_at_cutoff(self):
+        counter = bitbucket.RankedCounter()
+        for key in ['b', 'b', 'c', 'c', 'd']:
+            counter.add(key)
+        self.assertEqual(counter.top(2), [('b', 2), ('c', 2)])
+        counter.add('a', 2)
+        self.assertEqual(counter.top(2), [('a', 2), ('b', 2)])
+        counter.add('b', -1)
+        counter.add('b', 1)
+        self.assertEqual(counter.top(2), [('a', 2), ('b', 2)])
+
+    def test_top_zero(self):
+        counter = bitbucket.RankedCounter()
+        counter.add('a')
+        self.assertEqual(counter.top(0), [])
+        counter.add('b')
+        self.assertEqual(counter.top(0), [])
+        self.assertEqual(counter.top(-1), [])
+        self.assertEqual(counter.top(1), [('a', 1)])
+
+
+class ReferenceIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = bitbucket.ReferenceIndex()
+        self.index.record('a', 'issue', '3')
+        self.index.record('a', 'issue', '3')
+        self.index.record('a', 'changeset', 'abc')
+        self.index.record('b', 'issue', '3')
+        self.index.record('b', 'issue', 'x', valid=False)
+
+    def test_record(self):
+        self.assertEqual(self.index.total, 5)
+        self.assertEqual(self.index.total_invalid, 1)
+        self.assertEqual(self.index.documents.top(5), [('a', 3), ('b', 2)])
+        self.assertEqual(self.index.issues.top(5), [('3', 3)])
+        self.assertEqual(self.index.invalid, {'b': ['x']})
+
+    def test_purge_after_record(self):
+        self.index.purge('a')
+        self.index.purge('b')
+        self.assertEqual(self.index.refs, {})
+        self.assertEqual(self.index.total, 0)
+        self.assertEqual(self.index.total_invalid, 0)
+        self.assertEqual(len(self.index.documents), 0)
+        self.assertEqual(len(self.index.issues), 0)
+        self.assertEqual(self.index.issue_docs, {})
+        self.assertEqual(self.index.invalid, {})
+
+    def test_purge_one_document(self):
+        self.index.purge('a')
+        self.assertEqual(self.index.total, 2)
+        self.assertEqual(self.index.issues.top(5), [('3', 1)])
+        self.assertEqual(self.index.issue_docs, {'3': {'b': 1}})
+
+    def test_purge_unknown_document(self):
+        self.index.purge('missing')
+        self.assertEqual(self.index.total, 5)
+        self.assertEqual(self.index.documents.top(5), [('a', 3), ('b', 2)])
+
+    def test_closed(self):
+        self.assertEqual(self.index.closed([3, '3', 9]), [('3', ['a', 'b'])])
+
+    def test_closed_int_and_str(self):
+        self.index.record('c', 'issue', '1')
+        self.assertEqual(self.index.closed([1, '1']), [('1', ['c'])])
+
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, 'sub', 'history.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_save_truncates(self):
+        history = [{'references': i}
+                   for i in range(bitbucket.HISTORY_LENGTH + 5)]
+        saved = bitbucket.save_history(self.filename, history)
+        self.assertEqual(len(saved), bitbucket.HISTORY_LENGTH)
+        self.assertEqual(saved[-1], history[-1])
+        self.assertEqual(bitbucket.load_history(self.filename), saved)
+
+    def test_load_missing(self):
+        self.assertEqual(bitbucket.load_history(self.filename), [])
+
+
+class RoleTest(unittest.TestCase):
+
+    def setUp(self):
+        app = FakeApp(None)
+        self.env = FakeEnv(app, docname='intro')
+        self.inliner = FakeInliner(self.env)
+
+    def references(self):
+        return bitbucket.get_reference_index(self.env).refs.get('intro')
+
+    def test_issue(self):
+        result, messages = bitbucket.bbissue_role(
+            'bbissue', ':bbissue:`3`', '3', 1, self.inliner)
+        self.assertEqual(messages, [])
+        self.assertEqual(self.references(), [('issue', '3', True)])
+
+    def test_invalid_issue(self):
+        result, messages = bitbucket.bbissue_role(
+            'bbissue', ':bbissue:`x`', 'x', 1, self.inliner)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(self.references(), [('issue', 'x', False)])
+
+    def test_changeset_and_user(self):
+        bitbucket.bbchangeset_role(
+            'bbchangeset', ':bbchangeset:`abc`', 'abc', 1, self.inliner)
+        bitbucket.bbuser_role('bbuser', ':bbuser:`me`', 'me', 1, self.inliner)
+        self.assertEqual(self.references(),
+                         [('changeset', 'abc', True), ('user', 'me', True)])
+
+
+class EnvironmentEventTest(unittest.TestCase):
+
+    def test_outdated_without_index(self):
+        env = FakeEnv(found_docs=['a', 'b'])
+        result = bitbucket.outdated_documents(None, env, set(), set(), set())
+        self.assertEqual(sorted(result), ['a', 'b'])
+        self.assertEqual(env.bitbucket_references.total, 0)
+
+    def test_outdated_with_old_index(self):
+        env = FakeEnv(found_docs=['a', 'b'])
+        env.bitbucket_references = bitbucket.ReferenceIndex()
+        del env.bitbucket_references.version
+        result = bitbucket.outdated_documents(None, env, set(), set(), set())
+        self.assertEqual(sorted(result), ['a', 'b'])
+
+    def test_outdated_with_index(self):
+        env = FakeEnv(found_docs=['a', 'b'])
+        bitbucket.get_reference_index(env).record('a', 'issue', '1')
+        result = bitbucket.outdated_documents(None, env, set(), set(), set())
+        self.assertEqual(result, [])
+        self.assertEqual(env.bitbucket_references.total, 1)
+
+    def test_purge(self):
+        env = FakeEnv()
+        bitbucket.get_reference_index(env).record('a', 'issue', '1')
+        bitbucket.purge_references(None, env, 'a')
+        self.assertEqual(env.bitbucket_references.total, 0)
+
+    def test_merge(self):
+        env = FakeEnv()
+        bitbucket.get_reference_index(env).record('a', 'issue', '1')
+        other = FakeEnv()
+        other_index = bitbucket.get_reference_index(other)
+        other_index.record('b', 'issue', '1')
+        other_index.record('b', 'issue', 'x', valid=False)
+        other_index.record('c', 'user', 'me')
+        bitbucket.merge_references(None, env, ['b'], other)
+        index = env.bitbucket_references
+        self.assertEqual(index.total, 3)
+        self.assertEqual(index.issues.top(5), [('1', 2)])
+        self.assertEqual(index.invalid, {'b': ['x']})
+        self.assertNotIn('c', index.refs)
+
+
+class ReportPageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def make_app(self, **config):
+        app = FakeApp(self.dirname, **config)
+        index = bitbucket.get_reference_index(app.builder.env)
+        index.record('intro', 'issue', '3')
+        index.record('intro', 'issue', '3')
+        index.record('a"b<c>', 'issue', '4')
+        index.record('a"b<c>', 'issue', '<bad>', valid=False)
+        return app
+
+    def history_file(self, name='html'):
+        return os.path.join(self.dirname, 'bitbucket_history-%s.json' % name)
+
+    def test_disabled(self):
+        app = self.make_app(bitbucket_report_page=None)
+        self.assertEqual(bitbucket.collect_report_page(app), [])
+        self.assertFalse(os.path.exists(self.history_file()))
+
+    def test_page(self):
+        app = self.make_app(bitbucket_closed_issues=[4])
+        [(pagename, context, template)] = bitbucket.collect_report_page(app)
+        self.assertEqual(pagename, 'bitbucket-report')
+        self.assertEqual(template, 'page.html')
+        body = context['body']
+        self.assertIn('<a href="intro.html">intro</a>', body)
+        self.assertIn(
+            '<a href="https://bitbucket.org/owner/project/issue/3/">'
+            'issue 3</a>', body)
+        self.assertIn('<a href=\'a"b&lt;c&gt;.html\'>a"b&lt;c&gt;</a>', body)
+        self.assertIn('&lt;bad&gt;', body)
+        self.assertNotIn('<bad>', body)
+        self.assertIn('<h2>References to closed issues</h2>', body)
+
+    def test_size_zero(self):
+        app = self.make_app(bitbucket_report_size=0)
+        [(pagename, context, template)] = bitbucket.collect_report_page(app)
+        self.assertNotIn('<a href="intro.html">', context['body'])
+
+    def test_history_only_when_totals_change(self):
+        app = self.make_app()
+        bitbucket.collect_report_page(app)
+        bitbucket.collect_report_page(app)
+        history = bitbucket.load_history(self.history_file())
+        self.assertEqual(len(history), 1)
+        self.assertEqual(history[0]['references'], 4)
+        self.assertEqual(history[0]['invalid'], 1)
+        bitbucket.get_reference_index(app.builder.env).purge('intro')
+        bitbucket.collect_report_page(app)
+        history = bitbucket.load_history(self.history_file())
+        self.assertEqual([p['references'] for p in history], [4, 2])
+
+    def test_history_per_builder(self):
+        bitbucket.collect_report_page(self.make_app())
+        bitbucket.collect_report_page(self.make_app(builder_name='dirhtml'))
+        self.assertEqual(len(bitbucket.load_history(self.history_file())), 1)
+        self.assertEqual(
+            len(bitbucket.load_history(self.history_file('dirhtml'))), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()